@@ -58,7 +58,7 @@ class QBOErrorHandler(LoggedClass):
     """
     # 400 status_codes with API code 5010 seem related to entities, not entries, and specific to aplus, expensify, and
     # custom code. Not worrying about those for now.
-    SUPPORTED_STATUS_CODES = [200, 400]
+    SUPPORTED_STATUS_CODES = frozenset({200, 400})
 
     # 5010 = Stale Object Error
     # 610 = Object Not Found (This CAN be related to NON-caching problems, so further inspection is required)
@@ -76,7 +76,8 @@ class QBOErrorHandler(LoggedClass):
 
         try:
             if response is not None:
-                self.response = response
+                # response_data, when also given, is the already-decoded body of `response`
+                self._set_response(response, response_data=response_data)
 
             elif response_data is not None:
                 self.response_data = response_data
@@ -165,16 +166,24 @@ class QBOErrorHandler(LoggedClass):
 
     @response.setter
     def response(self, response: Union[requests.Response, None]) -> None:
+        self._set_response(response)
+
+    def _set_response(self,
+                      response: Union[requests.Response, None],
+                      response_data: Optional[Union[list, dict]] = None) -> None:
+        """Set the response, decoding its body unless the caller already has (`response_data`)."""
         self._response = response
-        response_data = {}
 
-        if self._response is not None:
+        if response_data is None:
+            response_data = {}
 
-            try:
-                response_data = self._response.json()
+            if self._response is not None:
 
-            except Exception:
-                self.exception()
+                try:
+                    response_data = self._response.json()
+
+                except Exception:
+                    self.exception()
 
         self.response_data = response_data
         self.faults = response_data
@@ -6,12 +6,18 @@ Copyright 2016-2024 FinOptimal, Inc. All rights reserved.
 import datetime
 import os
 import json
+import random
 import requests
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union, Optional
+from urllib.parse import parse_qs, urlparse
 from defusedxml import ElementTree
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from intuitlib.client import AuthClient
 from intuitlib.exceptions import AuthClientError
 from intuitlib.enums import Scopes
 from google.cloud.logging import DESCENDING
@@ -22,6 +28,14 @@ from finoptimal.storage.fo_darkonim_bucket import FODarkonimBucket
 from finoptimal.utilities import retry
 from fo_qbo.errors import RateLimitError, UnauthorizedError
 
+try:
+    # Optional, but a good deal faster than the standard library at decoding API responses
+    import orjson
+    json_loads = orjson.loads
+
+except ImportError:
+    json_loads = json.loads
+
 
 logger = get_logger(__name__)
 
@@ -29,6 +43,32 @@ logger = get_logger(__name__)
 CALLBACK_URL      = "http://a.b.com"
 
 
+class QBORetry(Retry):
+    """A urllib3 Retry that also resends throttled non-idempotent requests, and jitters its back-off.
+
+    Methods outside `allowed_methods` (i.e. POST, which creates, batches and queries all use) are never replayed after a
+    5xx or a read timeout, because QBO may have acted on them anyway. A 429 in `status_forcelist` is the exception: it
+    was turned away before QBO did anything, so it's retried whatever the method.
+
+    The exponential back-off is scaled by a random factor in BACKOFF_JITTER, since workers throttled in the same second
+    would otherwise all retry on the same schedule and trip the rate limit again. A Retry-After header, when the
+    response carries one, still takes precedence over the back-off.
+    """
+
+    BACKOFF_JITTER = (0.5, 1.5)
+
+    ANY_METHOD_STATUS_CODES = frozenset([429])
+
+    def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+        if status_code in self.ANY_METHOD_STATUS_CODES and status_code in (self.status_forcelist or ()):
+            return True
+
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def get_backoff_time(self) -> float:
+        return super().get_backoff_time() * random.uniform(*self.BACKOFF_JITTER)
+
+
 class QBAuth2(LoggedClass):
     """Facilitates interaction with the QBO API at the lowest level.
 
@@ -61,17 +101,84 @@ class QBAuth2(LoggedClass):
 
     MINOR_API_VERSION = 70
 
-    def __init__(self, client_code: str, modifier: Optional[str] = None, verbosity: int = 0, env: Optional[str] = None):
+    # Tokens shared by every instance in this process, keyed by (client_id, realm_id): (access_token, refresh_token,
+    # expires_at). This keeps sibling instances for the same realm from each exchanging the refresh token. Tokens only
+    # work with the app (client_id) that obtained them, so instances using another app's credentials (e.g. a different
+    # `modifier`) never share.
+    _TOKEN_CACHE = {}
+    _TOKEN_LOCK = threading.Lock()
+
+    # The requests keyword arguments (see request()'s `extra`) that httpx.Client.request also takes, under httpx's names
+    HTTP2_EXTRA_KWARGS = {
+        'allow_redirects' : 'follow_redirects',
+        'auth'            : 'auth',
+        'cookies'         : 'cookies',
+        'files'           : 'files',
+        'json'            : 'json',
+    }
+
+    # Seconds to wait on Intuit before giving up on a request (large reports can legitimately take a while)
+    DEFAULT_TIMEOUT_SECS = 300
+
+    # ...but establishing the connection should be quick; a stalled connect shouldn't tie up a pool slot for minutes
+    CONNECT_TIMEOUT_SECS = 10
+
+    # Transport-level back-off for throttling and server hiccups. 401s are NOT retried here because they need a token
+    # refresh first (see request()), and the final 429 response is still returned so request() can raise
+    # RateLimitError. POSTs are only resent after a 429 or a failed connect (see QBORetry): a create replayed after a
+    # 5xx or read timeout could save twice. Kept short, since _basic_call's own retries wrap these.
+    HTTP_RETRY = QBORetry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(['GET', 'PUT', 'DELETE']),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+
+    def __init__(self,
+                 client_code: str,
+                 modifier: Optional[str] = None,
+                 verbosity: int = 0,
+                 env: Optional[str] = None,
+                 http2: bool = False):
         super().__init__()
         # Bind relevant arguments
         self.client_code = client_code
+        self.http2 = http2
         self.vb = verbosity
         self.environment = "sandbox" if env and env == "sandbox" else "production"
 
+        # The name of the process responsible for this instance (static for the life of the process)
+        self.caller = os.path.basename(sys.argv[0]) if sys.argv else None
+
         # Set-up GCP loggers
         self.api_logger = GoogleCloudLogger('api-qbo')
         self.token_logger = GoogleCloudLogger('tokens-qbo')
 
+        if self.http2:
+            # Opt-in: multiplex every call over a single TLS connection (requires httpx[http2])
+            import httpx
+
+            self._http = httpx.Client(
+                http2=True,
+                limits=httpx.Limits(max_connections=8, max_keepalive_connections=8),
+                timeout=httpx.Timeout(self.DEFAULT_TIMEOUT_SECS, connect=self.CONNECT_TIMEOUT_SECS),
+            )
+
+        else:
+            # Reused for every API call so urllib3 can apply HTTP_RETRY and keep connections alive (pool_maxsize is
+            # sized for threaded callers hammering the same host)
+            self._http = requests.Session()
+            adapter = HTTPAdapter(pool_connections=10, pool_maxsize=50, max_retries=self.HTTP_RETRY)
+            self._http.mount('https://', adapter)
+            self._http.mount('http://', adapter)
+
+        # Guards refresh() so that concurrent callers don't each exchange the refresh token
+        self._refresh_lock = threading.Lock()
+        self._last_refresh = float('-inf')  # monotonic() counts from boot, so 0.0 could debounce the first refresh
+        self._background_refresh = None
+
         # We never start out with new tokens, they have to be retrieved from the API
         self.new_token = False
         self.new_refresh_token = False
@@ -87,7 +194,10 @@ class QBAuth2(LoggedClass):
         # Grab credentials and set the instance attributes used to initialize the session
         self._refresh_credential_attributes()
 
-        # Initialize the session, using the saved credentials (if any)
+        # Initialize the session, using the saved credentials (if any). intuitlib's client is only imported once
+        # something actually needs it.
+        from intuitlib.client import AuthClient
+
         self.session = AuthClient(
             self.client_id,
             self.client_secret,
@@ -97,6 +207,7 @@ class QBAuth2(LoggedClass):
             access_token=self.initial_access_token,
             realm_id=self.realm_id
         )
+        self._load_cached_tokens()
         self.reset_auth_client_error_retry_count()
 
         if self.realm_id is None:
@@ -151,7 +262,7 @@ class QBAuth2(LoggedClass):
         if not hasattr(self, '_initial_access_token'):
             self._initial_access_token = self.access_token
 
-            if self.expires_at and self.expires_at < str(datetime.datetime.utcnow()):
+            if self.access_token_expired:
                 self._initial_access_token = None
                 self.info(f"\n{self.realm_id}'s access_token has expired; not passing to AuthClient")
 
@@ -249,12 +360,90 @@ class QBAuth2(LoggedClass):
         return self._expires_at
 
 
+    @expires_at.setter
+    def expires_at(self, expires_at: Union[str, None]) -> None:
+        self._expires_at = expires_at
+
+        # Everything derived from the expiry is worked out here, once per token, because access_token_expiring gets
+        # checked before every request. The refresh deadline is kept on the monotonic clock.
+        self._expires_at_dt = self.parse_utc_timestamp(expires_at)
+
+        if self._expires_at_dt is None:
+            self._refresh_due_monotonic = float('inf')
+
+        else:
+            refresh_in = self._expires_at_dt - self.ACCESS_TOKEN_REFRESH_MARGIN - datetime.datetime.utcnow()
+            self._refresh_due_monotonic = time.monotonic() + refresh_in.total_seconds()
+
+
+    @staticmethod
+    def parse_utc_timestamp(timestamp: Union[str, None]) -> Union[datetime.datetime, None]:
+        """Parse one of our stored (UTC) timestamps into a naive datetime; None if it's missing or unparseable."""
+        try:
+            parsed = datetime.datetime.fromisoformat(timestamp)
+
+        except (TypeError, ValueError):
+            return None
+
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+        return parsed
+
+
+    @property
+    def expires_at_dt(self) -> Union[datetime.datetime, None]:
+        """datetime or None: `expires_at` (naive UTC)."""
+        return self._expires_at_dt
+
+
+    @property
+    def access_token_expiring(self) -> bool:
+        """bool: The access token expires within ACCESS_TOKEN_REFRESH_MARGIN (or already has)."""
+        return time.monotonic() >= self._refresh_due_monotonic
+
+
+    @property
+    def access_token_expired(self) -> bool:
+        """bool: The access token has a known expiration, and it has passed."""
+        return self.expires_at_dt is not None and self.expires_at_dt < datetime.datetime.utcnow()
+
+
     @property
     def rt_acquired_at(self) -> str:
         """str: The timestamp of when the refresh token was acquired."""
         return self._rt_acquired_at
 
 
+    @property
+    def auth_header(self) -> str:
+        """str: The Authorization header for the session's access token; rebuilt only after the token changes."""
+        auth_header = self.__dict__.get('_auth_header')
+
+        if auth_header is None:
+            auth_header = self._auth_header = f'Bearer {self.session.access_token}'
+
+        return auth_header
+
+
+    @auth_header.deleter
+    def auth_header(self) -> None:
+        # pop() rather than hasattr()/del, since a background refresh may be doing this while requests are in flight
+        self.__dict__.pop('_auth_header', None)
+        self.__dict__.pop('_base_headers', None)
+
+
+    @property
+    def base_headers(self) -> dict:
+        """dict: The headers every API call carries (shared between calls, so don't mutate it)."""
+        base_headers = self.__dict__.get('_base_headers')
+
+        if base_headers is None:
+            base_headers = self._base_headers = {'Authorization': self.auth_header}
+
+        return base_headers
+
+
     @property
     def minor_api_version(self) -> int:
         """int: The minor API version the client is using."""
@@ -266,18 +455,6 @@ class QBAuth2(LoggedClass):
         self._minor_api_version = version_number
 
 
-    @property
-    def caller(self) -> Union[str, None]:
-        """The name of the process responsible for this instance."""
-        if not hasattr(self, '_caller'):
-            try:
-                self._caller = os.path.split(sys.argv[0])[-1]
-            except Exception:
-                self._caller = None
-
-        return self._caller
-
-
     def _get_credentials(self) -> dict:
         """Returns the credentials (client + service account) from the Google Cloud bucket."""
         credentials = self.fo_darkonim.credentials.copy()
@@ -307,7 +484,7 @@ class QBAuth2(LoggedClass):
         self._access_token = self.credentials.get('access_token')
         self._refresh_token = self.credentials.get('refresh_token')
         self._realm_id = self.credentials.get('company_id')
-        self._expires_at = self.credentials.get('expires_at')
+        self.expires_at = self.credentials.get('expires_at')
         self._rt_acquired_at = self.credentials.get('rt_acquired_at')
         self.minor_api_version = self.credentials.get('minor_api_version')
         self.minor_api_version = self.minor_api_version if self.minor_api_version else self.MINOR_API_VERSION
@@ -375,20 +552,29 @@ class QBAuth2(LoggedClass):
         if not self.new_token:
             return
 
-        self._expires_at = str(datetime.datetime.utcnow() + datetime.timedelta(minutes=55))
+        now = datetime.datetime.utcnow()
+        self._update_expires_at(now)
 
         new_credentials = self.active_credentials.copy()
         self.info(f'New credentials: {new_credentials}')
 
         if self.new_refresh_token:
-            new_credentials['rt_acquired_at'] = str(datetime.datetime.utcnow())
+            new_credentials['rt_acquired_at'] = str(now)
 
         self.credentials = new_credentials
+        self._cache_tokens()
 
         self.new_token = False
         self.new_refresh_token = False
 
 
+    def _update_expires_at(self, now: datetime.datetime) -> None:
+        """Set `expires_at` for the access token the session was just issued (at `now`, UTC)."""
+        # intuitlib keeps the lifetime Intuit reported with the token; fall back to the usual hour if it's missing
+        expires_in = getattr(self.session, 'expires_in', None) or self.ACCESS_TOKEN_LIFESPAN_SECS
+        self.expires_at = str(now + datetime.timedelta(seconds=int(expires_in)) - self.ACCESS_TOKEN_EXPIRY_CUSHION)
+
+
     def reload_credentials(self) -> None:
         """Reload credentials from the Google Cloud bucket and reset the related attributes."""
         del self.credentials
@@ -397,38 +583,64 @@ class QBAuth2(LoggedClass):
 
     @retry(max_tries=4, exceptions=(UnauthorizedError,))
     @logger.timeit(**returns, expand=True)
-    def request(self, request_type, url, header_auth=True, realm='', verify=True, headers=None, data=None, **params):
+    def request(self, request_type, url, header_auth=True, realm='', verify=True, headers=None, data=None,
+                params=None, timeout=None, stream=False, extra=None):
         """
         We don't handle authorization until the session's first request happens.
+
+        `params`, `timeout` and `stream` are handed straight to requests; anything less common can be passed along via
+        the `extra` dict. A `timeout` of None means (CONNECT_TIMEOUT_SECS, DEFAULT_TIMEOUT_SECS).
+
+        Streamed bodies are left for the caller to consume (they aren't decoded for the log).
         """
         self.establish_access()
-        auth_header = f'Bearer {self.session.access_token}'
-        _headers = {
-            'Authorization': auth_header,
-        }
+        _headers = {**self.base_headers, **headers} if headers else self.base_headers
 
-        for key, val in headers.items():
-            _headers[key] = val
-            
         if self.vb > 19:
             self.print("QBA headers", _headers)
 
         msg = f'Making {request_type.upper()} request to {url}'
 
-        self.api_logger.info(msg, method=request_type.upper(), url=url, data=json.dumps(data)[:5000])
+        # Bodies can be bytes (orjson-encoded JSON, multipart uploads) and large, so only the head gets logged
+        if isinstance(data, bytes):
+            logged_data = data[:5000].decode('utf-8', 'replace')
+        elif isinstance(data, str):
+            logged_data = data[:5000]
+        else:
+            logged_data = data
+
+        self.api_logger.info(msg, method=request_type.upper(), url=url, data=json.dumps(logged_data)[:5000])
+
+        timeout = (self.CONNECT_TIMEOUT_SECS, self.DEFAULT_TIMEOUT_SECS) if timeout is None else timeout
+
+        if self.http2:
+            resp = self._http2_request(request_type.upper(), url, _headers, data, params, timeout, verify=verify,
+                                       extra=extra)
+
+        else:
+            resp = self._http.request(
+                method=request_type.upper(),
+                url=url,
+                headers=_headers,
+                data=data,
+                params=params,
+                timeout=timeout,
+                stream=stream,
+                verify=verify,
+                **(extra or {})
+            )
 
-        resp = requests.request(method=request_type.upper(), url=url, headers=_headers, data=data, **params)
         status_code = str(resp.status_code)
         method = str(resp.request.method.ljust(4))
         reason = str(resp.reason)
         response_url = str(resp.url)
         
         try:
-            msg = (f"{resp.__hash__()} - {self.caller} - {self.client_code}({self.business_context}) - "
-                   f"{status_code} {reason} - {method} {response_url} - {resp.json()}")
+            msg = (f"{id(resp):x} - {self.caller} - {self.client_code}({self.business_context}) - "
+                   f"{status_code} {reason} - {method} {response_url} - {None if stream else json_loads(resp.content)}")
 
         except Exception:
-            msg = (f"{resp.__hash__()} - {self.caller} - {self.client_code}({self.business_context}) - "
+            msg = (f"{id(resp):x} - {self.caller} - {self.client_code}({self.business_context}) - "
                    f"{status_code} {reason} - {method} {response_url} - None")
 
         self.api_logger.info(msg[:5000], method=method, status_code=status_code, reason=reason, url=response_url)
@@ -496,6 +708,67 @@ class QBAuth2(LoggedClass):
         return resp
 
 
+    def request_many(self, specs: list, max_workers: int = 8) -> list:
+        """Make several requests concurrently, sharing the pooled connections (and access token).
+
+        Parameters
+        ----------
+        specs : list of dict
+            The keyword arguments for `request()`, one dict per call, e.g. {'request_type': 'GET', 'url': url}.
+        max_workers : int
+            The most requests in flight at once.
+
+        Returns
+        -------
+        list
+            The responses, in the same order as `specs`.
+        """
+        # Settle authorization once up front rather than in every worker thread at the same time
+        self.establish_access()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda spec: self.request(**spec), specs))
+
+
+    def _http2_request(self, method, url, headers, data, params, timeout, verify=True, extra=None) -> requests.Response:
+        """Make the call over the httpx client, but hand back a requests.Response so that callers can't tell.
+
+        The body is always read in full (`stream` doesn't apply) and urllib3's HTTP_RETRY isn't in play here. The
+        `extra` requests arguments httpx has an equivalent for (HTTP2_EXTRA_KWARGS) are passed along; any others, and
+        verify=False (httpx only takes that per client), raise TypeError rather than being quietly dropped.
+        """
+        if not verify:
+            raise TypeError("verify=False isn't supported over HTTP/2 (httpx only takes it per client)")
+
+        unsupported = set(extra or {}) - set(self.HTTP2_EXTRA_KWARGS)
+
+        if unsupported:
+            raise TypeError(f"Request argument(s) not supported over HTTP/2: {', '.join(sorted(unsupported))}")
+
+        kwargs = {self.HTTP2_EXTRA_KWARGS[ky]: vl for ky, vl in (extra or {}).items()}
+        # requests follows redirects unless told otherwise; httpx doesn't
+        kwargs.setdefault('follow_redirects', True)
+
+        if isinstance(timeout, tuple):
+            # requests' (connect, read) form
+            import httpx
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+
+        hresp = self._http.request(method, url, headers=headers, content=data, params=params, timeout=timeout, **kwargs)
+
+        resp = requests.Response()
+        resp.status_code = hresp.status_code
+        resp.reason = hresp.reason_phrase
+        resp.headers = requests.structures.CaseInsensitiveDict(hresp.headers)
+        resp.url = str(hresp.url)
+        resp.encoding = hresp.encoding
+        resp._content = hresp.content
+        resp._content_consumed = True  # There's no raw stream behind it, so close() must not try to drain one
+        resp.request = requests.Request(method, resp.url, headers=headers, data=data).prepare()
+
+        return resp
+
+
     @property
     def last_call_was_unauthorized(self):
         if not hasattr(self, "_last_call_was_unauthorized"):
@@ -514,8 +787,19 @@ class QBAuth2(LoggedClass):
         """
         This is called at the beginning of every request. Looks to me like this was simply meant to establish the
         initial connection, whether that be an access_token refresh or oob().
+
+        Once we have access, an access token that's about to expire is refreshed here rather than waiting for Intuit to
+        reject it (the 401 handling in request() remains as a fallback). While it's still valid, that refresh happens
+        on a background thread so the caller's request goes ahead with the current token.
         """
         if getattr(self, "_has_access", False):
+            if self.access_token_expired:
+                self.info(f"\n{self.realm_id}'s access_token has expired; refreshing")
+                self.refresh(force=True)
+
+            elif self.access_token_expiring:
+                self.refresh_in_background()
+
             return
         
         if self.refresh_token is None:
@@ -529,11 +813,18 @@ class QBAuth2(LoggedClass):
             # much better. TODO
             self.oob()
 
-        if self.access_token is None:
-            self.info(f'\nNo {self.realm_id} access_token available, attempting to refresh using refresh_token...')
+            # The bearer token exchange just handed us a brand-new access token (and its expires_at), so there's nothing
+            # to refresh
+            self._has_access = True
+            return
+
+        # A stored access token that is still fresh (per the persisted expires_at) gets used as is, so a new process
+        # doesn't pay for a refresh round-trip. One that's stale would only earn us a 401, so refresh it up front.
+        if self.access_token is None or self.access_token_expiring:
+            self.info(f'\nNo fresh {self.realm_id} access_token available, attempting to refresh using refresh_token...')
                 
             try:
-                self.refresh()
+                self.refresh(force=self.access_token is not None)
 
             except Exception:
                 # Now we expect refresh() to handle ALL AuthClientErrors internally, so we WILL raise an exception here.
@@ -552,22 +843,24 @@ class QBAuth2(LoggedClass):
         self.print("Please send the user here to authorize this app to access their QBO data:\n")
         self.print(self.authorize_url)
 
-        authorized_callback_url = None
+        authorized_callback_url = input("\nPaste the entire callback URL back here (or ctrl-c):").strip()
 
-        while not authorized_callback_url:
-            authorized_callback_url = input("\nPaste the entire callback URL back here (or ctrl-c):")
+        if not urlparse(authorized_callback_url).query:
+            raise ValueError(f"{authorized_callback_url!r} is missing the callback URL's query string!")
 
         self.handle_authorized_callback_url(authorized_callback_url)
 
 
     @logger.timeit(**void)
     def handle_authorized_callback_url(self, url):
-        tail = url.split("?")[1].strip()
-        params = dict([tuple(param.split("=")) for param in tail.split("&")])
+        params = {ky: vl[0] for ky, vl in parse_qs(urlparse(url.strip()).query).items()}
         self.session.get_bearer_token(params['code'])
+        del self.auth_header
         self._realm_id = params["realmId"]
         self._access_token = self.session.access_token
         self._refresh_token = self.session.refresh_token
+        # Otherwise the old token's expiry would stick around and get this brand-new token force-refreshed
+        self._update_expires_at(datetime.datetime.utcnow())
 
         if self.vb > 2:
             self.print(f"\nThis company's (realm) ID: {self.realm_id}")
@@ -610,18 +903,130 @@ class QBAuth2(LoggedClass):
 
         self.token_logger.info(msg, refresh_token=self.refresh_token, access_token=self.access_token)
 
+    @property
+    def token_cache_key(self) -> tuple:
+        """tuple: (client_id, realm_id), which `_TOKEN_CACHE` entries are kept under."""
+        return self.client_id, self.realm_id
+
+
+    def _cache_tokens(self) -> None:
+        """Share the current tokens with the other instances for this realm (and app)."""
+        if self.realm_id is None:
+            return
+
+        with self._TOKEN_LOCK:
+            self._TOKEN_CACHE[self.token_cache_key] = (self.access_token, self.refresh_token, self.expires_at)
+
+
+    def _load_cached_tokens(self) -> bool:
+        """Adopt tokens another instance for this realm (and app) obtained, if they're newer than ours and unexpired."""
+        with self._TOKEN_LOCK:
+            cached = self._TOKEN_CACHE.get(self.token_cache_key)
+
+        if cached is None:
+            return False
+
+        access_token, refresh_token, expires_at = cached
+        cached_expires_at_dt = self.parse_utc_timestamp(expires_at)
+
+        if (
+            access_token == self.access_token or
+            cached_expires_at_dt is None or
+            cached_expires_at_dt < datetime.datetime.utcnow() or
+            (self.expires_at_dt is not None and cached_expires_at_dt <= self.expires_at_dt)
+        ):
+            return False
+
+        self._access_token = access_token
+        self._refresh_token = refresh_token
+        self.expires_at = expires_at
+        self.session.access_token = access_token
+        self.session.refresh_token = refresh_token
+        del self.auth_header
+
+        return True
+
+
     MAX_AUTH_RETRIES = 2
 
+    # Lifetime assumed when the token response doesn't say (Intuit issues one-hour access tokens), and how much of
+    # it to shave off when recording expires_at
+    ACCESS_TOKEN_LIFESPAN_SECS = 3600
+    ACCESS_TOKEN_EXPIRY_CUSHION = datetime.timedelta(minutes=5)
+
+    # How long before `expires_at` establish_access() refreshes the access token on its own
+    ACCESS_TOKEN_REFRESH_MARGIN = datetime.timedelta(seconds=60)
+
+    # Refreshes requested within this many seconds of a successful one are assumed to be redundant (e.g. a wave of
+    # concurrent 401s caused by the same expired access token).
+    REFRESH_DEBOUNCE_SECS = 5
+
+    # How long close() waits for a background refresh, which may have rotated the refresh token but not yet saved it
+    BACKGROUND_REFRESH_JOIN_SECS = 15
+
     @retry(max_tries=3, delay_secs=5, exceptions=(AuthClientError, ))
     @logger.timeit(**void)
-    def refresh(self) -> None:
+    def refresh(self, force: bool = False) -> None:
+        """Serialize token refreshes across threads so that only one exchange happens per expiry.
+
+        Parameters
+        ----------
+        force : bool
+            Skip the false-positive AuthClientError guard, i.e. refresh even though the access token hasn't expired.
+        """
+        # The token this caller was working with; if it has changed once we hold the lock, whoever held it before us
+        # already did the exchange.
+        stale_access_token = self.session.access_token
+
+        with self._refresh_lock:
+            if self.session.access_token != stale_access_token:
+                return
+
+            if time.monotonic() - self._last_refresh < self.REFRESH_DEBOUNCE_SECS:
+                return
+
+            if self._load_cached_tokens():
+                self.info(f"Using {self.realm_id}'s tokens refreshed by another instance")
+                self._last_refresh = time.monotonic()
+                return
+
+            self._refresh(force=force)
+            self._cache_tokens()
+
+
+    def refresh_in_background(self) -> None:
+        """Refresh the (still valid) access token on another thread, unless that's already under way.
+
+        The thread is a daemon, so a slow (retrying) exchange can't hold up interpreter exit; close() gives it up to
+        BACKGROUND_REFRESH_JOIN_SECS to finish saving the new tokens.
+        """
+        if self._background_refresh is not None and self._background_refresh.is_alive():
+            return
+
+        self.info(f"\n{self.realm_id}'s access_token is about to expire; refreshing in the background")
+        self._background_refresh = threading.Thread(
+            target=self._refresh_quietly, name=f'qbo-refresh-{self.realm_id}', daemon=True)
+        self._background_refresh.start()
+
+
+    def _refresh_quietly(self) -> None:
+        # A failure here isn't fatal: establish_access() refreshes synchronously once the token actually expires
+        try:
+            self.refresh(force=True)
+
+        except Exception:
+            self.exception()
+
+
+    def _refresh(self, force: bool = False) -> None:
         # I am adding this as defence against the irrational AuthClientErrors that Intuit throws from time to time,
         # which leads to excessive token exchanges. If we hit this condition there is a good chance Intuit threw a
         # false positive.
         if (
+            not force and
             self.auth_client_error_retry_count == 0 and
             self.expires_at and
-            self.expires_at >= str(datetime.datetime.utcnow())
+            not self.access_token_expired
         ):
             self.increment_auth_client_error_retry_count()
             self.token_logger.info('Potential false positive AuthClientError detected')
@@ -687,9 +1092,13 @@ class QBAuth2(LoggedClass):
             # (Now we're back to the else: of the except above)
 
             self.reset_auth_client_error_retry_count()
+            self._last_refresh = time.monotonic()
+            del self.auth_header
             return
 
         else:
+            self._last_refresh = time.monotonic()
+            del self.auth_header
             self.last_call_was_unauthorized = False
             self.reset_auth_client_error_retry_count()
             self.new_token = True
@@ -713,6 +1122,15 @@ class QBAuth2(LoggedClass):
 
         self._logged_in = False
         self._delete_credentials()
+        self.close()
+
+
+    def close(self) -> None:
+        """Release the pooled API connections (after letting a background refresh finish, within reason)."""
+        if self._background_refresh is not None:
+            self._background_refresh.join(timeout=self.BACKGROUND_REFRESH_JOIN_SECS)
+
+        self._http.close()
 
     @retry(max_tries=3, delay_secs=0.5, drag_factor=2)
     def get_token_log_entries(self) -> list:
@@ -790,7 +1208,7 @@ class QBAuth2(LoggedClass):
                 (not self.expires_at or expires_at >= self.expires_at)):
             fixed = True
             self._access_token = access_token
-            self._expires_at = expires_at
+            self.expires_at = expires_at
             self.session.access_token = access_token
 
             if refresh_token != self.refresh_token:
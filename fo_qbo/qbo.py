@@ -1,6 +1,8 @@
 import datetime
+import functools
 import pytz
 import re
+import sys
 
 # TODO:
 #  This already exists in the finoptimal package for the most part. Both classes were meant to phase out all the
@@ -18,7 +20,7 @@ class QBO:
 
     EPOCH = "1980-01-01T00:00:00.000000"
     TIME_FORMATTER = "%Y-%m-%dT%H:%M:%S.%f"
-    EPOCH_DT = pytz.utc.localize(datetime.datetime.strptime(EPOCH, TIME_FORMATTER))
+    EPOCH_DT = pytz.utc.localize(datetime.datetime.fromisoformat(EPOCH))
 
     NAME_LIST_OBJECTS = [
         "Account",
@@ -40,6 +42,7 @@ class QBO:
 
     # entity is the table name used by QBO for all of these
     ENTITY_OBJECTS = ["Customer", "Employee", "Vendor"]
+    ENTITY_OBJECTS_SET = frozenset(ENTITY_OBJECTS)
 
     # QBO refers to these as Entry objects and includes the NON_POSTING_TRANSACTION_OBJECTS below. QBO calls
     # TimeActivity a transaction object, but FO does not.
@@ -62,7 +65,8 @@ class QBO:
     NON_POSTING_TRANSACTION_OBJECTS = ["Estimate", "ReimburseCharge", "PurchaseOrder"]
 
     ENTRY_OBJECTS = TRANSACTION_OBJECTS + NON_POSTING_TRANSACTION_OBJECTS
-    POSTING_TRANSACTION_OBJECTS = list(set(TRANSACTION_OBJECTS).difference(NON_POSTING_TRANSACTION_OBJECTS))
+    ENTRY_OBJECTS_SET = frozenset(ENTRY_OBJECTS)
+    POSTING_TRANSACTION_OBJECTS = sorted(frozenset(TRANSACTION_OBJECTS) - frozenset(NON_POSTING_TRANSACTION_OBJECTS))
 
     OTHER_OBJECTS = [
         # "CompanyInfo",   # query by Metadata.LastUpdatedTime doesn't work!
@@ -95,14 +99,19 @@ class QBO:
 
     UNCACHABLE_OBJECTS = ["ExchangeRate"]
 
-    CDC_OBJECTS = list(set(OBJECT_TYPES)
-                       .difference(BROKEN_CDC_OBJECTS)
-                       .difference(NOT_IMPLEMENTED_TYPES)
-                       .difference(UNCACHABLE_OBJECTS))
+    # The derived collections below are kept as (sorted, so deterministic) lists for callers that iterate or concatenate
+    # them; the *_SET frozensets are for membership tests.
+    CDC_OBJECTS_SET = (
+        frozenset(OBJECT_TYPES) - frozenset(BROKEN_CDC_OBJECTS) - frozenset(NOT_IMPLEMENTED_TYPES)
+        - frozenset(UNCACHABLE_OBJECTS)
+    )
+    CDC_OBJECTS = sorted(CDC_OBJECTS_SET)
 
-    CACHABLE_OBJECTS = list(
-        set(CDC_OBJECTS + BROKEN_CDC_OBJECTS) - set(NOT_IMPLEMENTED_TYPES) - set(UNCACHABLE_OBJECTS)
+    CACHABLE_OBJECTS_SET = (
+        (CDC_OBJECTS_SET | frozenset(BROKEN_CDC_OBJECTS)) - frozenset(NOT_IMPLEMENTED_TYPES)
+        - frozenset(UNCACHABLE_OBJECTS)
     )
+    CACHABLE_OBJECTS = sorted(CACHABLE_OBJECTS_SET)
 
     MASK_NAMES = {
         "Account"       : "account",
@@ -208,6 +217,10 @@ class QBO:
         'VendorCredit'      : 'entry_id'
     }
 
+    # Object types whose rows live in the shared entry / entity tables
+    ENTRY_ID_OBJECTS = frozenset(ky for ky, vl in OBJECT_ID_MAP.items() if vl == 'entry_id')
+    ENTITY_ID_OBJECTS = frozenset(ky for ky, vl in OBJECT_ID_MAP.items() if vl == 'entity_id')
+
     MERGE_EVENT_COLUMN_MAP = {
         'Account': {
             'stale_columns': ['line_account', 'header_account', 'entry_deposit_account'],
@@ -253,12 +266,18 @@ class QBO:
         },
     }
 
+    # Membership views of each stale_columns list, for "is this column stale?" checks
+    MERGE_EVENT_STALE_COLUMN_SETS = {ky: frozenset(vl['stale_columns']) for ky, vl in MERGE_EVENT_COLUMN_MAP.items()}
+
+    CAP_WORD_RE = re.compile(r'[A-Z][a-z]+')
+
 
     @classmethod
     def split_words(cls, cap_word: str) -> list:
-        return re.findall(r'[A-Z][a-z]+', cap_word)
+        return cls.CAP_WORD_RE.findall(cap_word)
 
     @classmethod
+    @functools.lru_cache(maxsize=None)
     def get_table_name(cls, object_type: str) -> str:
         """Get the database table name for the QBO API object.
 
@@ -270,11 +289,11 @@ class QBO:
         -------
         str
         """
-        if cls.OBJECT_ID_MAP.get(object_type) == 'entry_id':
+        if object_type in cls.ENTRY_ID_OBJECTS:
             # Entry-type (transaction) objects share a table
             table_name = f'{cls.NAME}_entry'
 
-        elif cls.OBJECT_ID_MAP.get(object_type) == 'entity_id':
+        elif object_type in cls.ENTITY_ID_OBJECTS:
             # Entity-type objects share a table
             table_name = f'{cls.NAME}_entity'
 
@@ -284,9 +303,10 @@ class QBO:
 
             table_name = '_'.join(words)
 
-        return table_name.lower()
+        return sys.intern(table_name.lower())
 
     @classmethod
+    @functools.lru_cache(maxsize=None)
     def get_model_name(cls, object_type: str) -> str:
         """Get the database model name for the QBO API object.
 
@@ -298,13 +318,16 @@ class QBO:
         -------
         str
         """
-        if object_type in cls.ENTRY_OBJECTS:
-            return f'{cls.NAME}Entry'
+        if object_type in cls.ENTRY_OBJECTS_SET:
+            model_name = f'{cls.NAME}Entry'
+
+        elif object_type in cls.ENTITY_OBJECTS_SET:
+            model_name = f'{cls.NAME}Entity'
 
-        if object_type in cls.ENTITY_OBJECTS:
-            return f'{cls.NAME}Entity'
+        else:
+            model_name = f'{cls.NAME}{object_type}'
 
-        return f'{cls.NAME}{object_type}'
+        return sys.intern(model_name)
 
     @classmethod
     def get_object_id(cls, object_type: str) -> str:
@@ -11,31 +11,66 @@ Please contact developer@finoptimal.com with questions or comments.
 Copyright 2016-2024 FinOptimal, Inc. All rights reserved.
 """
 import collections
+import contextlib
 import datetime
+import functools
 import json
+import logging
 import os
 import pandas
-import textwrap
-from base64 import b64encode
+import shutil
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Union, Optional
 
 import google.cloud.logging as logging_gcp
+from google.cloud.logging.handlers import CloudLoggingHandler
+from google.cloud.logging.handlers.transports import BackgroundThreadTransport
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.filepost import encode_multipart_formdata
 from intuitlib.exceptions import AuthClientError
 
 from django.conf import settings
 from finoptimal import environment
 from finoptimal.logging import LoggedClass, get_logger, void, returns
 from finoptimal.utilities import retry
-from fo_qbo.errors import SuspectedTransientError, QBOErrorHandler, RateLimitError
+from fo_qbo.errors import BusinessValidationError, SuspectedTransientError, QBOErrorHandler, RateLimitError
 from .mime_types import MIME_TYPES
 from .qba import QBAuth2
 from .qbo import QBO
 
+try:
+    # Optional, but a good deal faster than the standard library for request and response bodies. Note that dumps gives
+    #  bytes, with non-ASCII characters as raw UTF-8 where json.dumps writes \uXXXX escapes (hence the charset that
+    #  _basic_call declares).
+    import orjson
+    json_dumps = functools.partial(orjson.dumps, option=orjson.OPT_NON_STR_KEYS)
+    json_loads = orjson.loads
+
+except ImportError:
+    json_dumps = json.dumps
+    json_loads = json.loads
+
 logger = get_logger(__name__)
 
-client = logging_gcp.Client()
-api_logger = client.logger('api-qbo')
+# Records are batched and shipped to GCP from a background thread, so logging never adds a blocking round-trip on top
+#  of the QBO call being logged. That handler (a GCP client plus its thread) is only set up by _get_api_logger() on
+#  first use: importing this module stays cheap, and a pre-fork parent doesn't start a thread its workers won't have.
+api_logger = logging.getLogger('api-qbo')
+api_logger.setLevel(logging.INFO)
+api_logger.propagate = False
+_api_logger_lock = threading.Lock()
+
+
+def _get_api_logger() -> logging.Logger:
+    if not api_logger.handlers:
+        with _api_logger_lock:
+            if not api_logger.handlers:
+                api_logger.addHandler(CloudLoggingHandler(
+                    logging_gcp.Client(), name='api-qbo', transport=BackgroundThreadTransport))
+
+    return api_logger
 
 
 class QBS(LoggedClass):
@@ -54,20 +89,44 @@ class QBS(LoggedClass):
         '\u2013': "-",
         '\uff0c': ", ",
     }
+    BAD_CHARS_TABLE = str.maketrans(BAD_CHARS)
 
     ALIASES = {
         "CreditCardPayment": "CreditCardPaymentTxn",
     }
 
-    def __init__(self, client_code: str, verbosity: int = 0, modifier: Optional[str] = None):
+    # How much of a request body _basic_call's (unconditionally built) trace note includes
+    NOTE_DATA_CHARS = 1500
+
+    # Read size when copying downloads to disk
+    DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+    # How many values get_missing() puts in each WHERE ... IN (...) query
+    MAX_WHERE_IN_VALUES = 999
+
+    # Object types without an Active flag, so get_where_in_query_string() mustn't filter on it
+    NO_ACTIVE_FLAG_OBJECTS = frozenset(QBO.TRANSACTION_OBJECTS) | frozenset(QBO.OTHER_OBJECTS)
+
+    # QBO accepts at most this many operations per batch request
+    MAX_BATCH_ITEMS = 30
+
+    def __init__(self,
+                 client_code: str,
+                 verbosity: int = 0,
+                 modifier: Optional[str] = None,
+                 http2: Optional[bool] = None):
         """
         This only works with a single company_id at a time.
 
         You must pass in a client_id and client_secret, or a refresh_token to bypass OOB authentication.
+
+        `http2` selects QBAuth2's httpx transport, which multiplexes concurrent calls (e.g. query(max_workers=...))
+        over one connection. When it isn't given, FO_QBO_TRANSPORT=httpx in the environment turns it on.
         """
         super().__init__()
         self.client_code = client_code
         self.vb = verbosity
+        self.http2 = os.environ.get("FO_QBO_TRANSPORT", "requests") == "httpx" if http2 is None else http2
 
         self.qbo_env = "sandbox" \
             if settings.configured and settings.DATABASES['default']['NAME'] != 'themagic' \
@@ -82,6 +141,12 @@ class QBS(LoggedClass):
         self.oauth_version = self.OAUTH_VERSION
         self.modifier = modifier
 
+        # Guards building and discarding `qba`, which worker threads (query/get_missing with max_workers) share
+        self._qba_lock = threading.Lock()
+
+        # batch_context()'s state, kept per thread so that other threads sharing this instance aren't swept into it
+        self._batch_local = threading.local()
+
         if self.qbo_env == "sandbox":
             self.info(f'API_BASE_URL = {self.API_BASE_URL}')
 
@@ -89,19 +154,70 @@ class QBS(LoggedClass):
     @property
     def qba(self):
         if not hasattr(self, '_qba'):
-            self._qba = QBAuth2(
-                client_code=self.client_code, modifier=self.modifier, verbosity=self.vb, env=self.qbo_env)
+            with self._qba_lock:
+                if not hasattr(self, '_qba'):
+                    self._qba = QBAuth2(
+                        client_code=self.client_code, modifier=self.modifier, verbosity=self.vb, env=self.qbo_env,
+                        http2=self.http2)
 
         return self._qba
 
 
     @qba.deleter
     def qba(self):
-        if hasattr(self, '_qba'):
-            self.note([
-                f"Deleting possibly-broken {self._qba} (with {self._qba.session}) and waiting 3 seconds...",
-            ], log=True, sleep=3)
-            del self._qba
+        with self._qba_lock:
+            qba = self.__dict__.pop('_qba', None)
+
+            if qba is not None:
+                self.note([
+                    f"Deleting possibly-broken {qba} (with {qba.session}) and waiting 3 seconds...",
+                ], log=True, sleep=3)
+                del self.realm_url
+
+
+    @property
+    def _batch_queue(self) -> Optional[list]:
+        """list or None: This thread's (item, future) pairs queued inside batch_context(), otherwise None."""
+        return getattr(self._batch_local, 'queue', None)
+
+
+    @_batch_queue.setter
+    def _batch_queue(self, queue: Optional[list]) -> None:
+        self._batch_local.queue = queue
+
+
+    @property
+    def download_session(self) -> requests.Session:
+        """requests.Session: Pooled session for fetching attachment download links.
+
+        Kept apart from `qba`'s session, because the (pre-signed) download links must not receive the QBO bearer token.
+        """
+        if not hasattr(self, '_download_session'):
+            self._download_session = requests.Session()
+            self._download_session.mount(
+                'https://', HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=QBAuth2.HTTP_RETRY))
+
+        return self._download_session
+
+
+    @property
+    def realm_url(self) -> str:
+        """str: The API base URL for this company (realm), which every endpoint URL starts with."""
+        if hasattr(self, '_realm_url'):
+            return self._realm_url
+
+        realm_url = f"{self.API_BASE_URL}/{self.cid}"
+
+        if self.cid is not None:
+            # Only remember it once there's a realm to remember
+            self._realm_url = realm_url
+
+        return realm_url
+
+
+    @realm_url.deleter
+    def realm_url(self):
+        self.__dict__.pop('_realm_url', None)
 
 
     @property
@@ -174,14 +290,15 @@ class QBS(LoggedClass):
     def _basic_call(self, request_type, url, data=None, **params):
         """
         params often get used for the Reports API, not for CRUD ops.
+
+        stream=True leaves a non-JSON (e.g. PDF) body unread for the caller to copy out of the returned response.
         """
+        stream = params.pop("stream", False)
+        # False leaves the Faults of individual batch items (in an otherwise successful batch response) to the caller
+        raise_item_faults = params.pop("raise_item_faults", True)
+        request_type = request_type.upper()
         headers  = {"accept": "application/json"}
-        # original_params = params.copy()
-        # original_data   = None
 
-        # if isinstance(data, str):
-        #     original_data = data + ""
-            
         if "minorversion" not in params.get("params", {}) and self.mav is not None:
             if "params" not in params:
                 params["params"] = {}
@@ -190,22 +307,22 @@ class QBS(LoggedClass):
 
         if "download" in url:
             headers = {}
-        elif "/pdf" == url[-4:]:
+        elif url.endswith("/pdf"):
             headers = {"content-type": "application/pdf"}
 
-        if request_type.lower() in ["post"]:
-            if url[-4:] == "send":
+        if request_type == "POST":
+            if url.endswith("send"):
                 headers.update({"Content-Type": "application/octet-stream"})
 
             elif isinstance(data, dict):
-                orig_data = data.copy()  # For Troubleshooting
                 if "headers" in data:
                     # It should be a dict, then...
                     headers = data["headers"].copy()       # must be a dict
-                    data    = data["request_body"] + ""    # should be text
+                    data    = data["request_body"]         # text or bytes
                 else:
-                    headers["Content-Type"] = "application/json"
-                    data = json.dumps(data)
+                    # Spelled out because orjson sends non-ASCII as UTF-8 (the stdlib's escaped ASCII is UTF-8, too)
+                    headers["Content-Type"] = "application/json; charset=utf-8"
+                    data = json_dumps(data)
             else:
                 # (basically for queries only)
                 headers["Content-Type"] = "application/text"
@@ -230,7 +347,7 @@ class QBS(LoggedClass):
             self.print(json.dumps(headers, indent=4))
 
         self.last_call = {
-            "request_type": request_type.upper(),
+            "request_type": request_type,
             "url"         : url,
             "realm"       : self.cid,
             "header"      : headers,
@@ -241,14 +358,16 @@ class QBS(LoggedClass):
 
         try:
             response = self.qba.request(
-                request_type.upper(),
+                request_type,
                 url,
                 header_auth=True,
                 realm=self.cid,
                 verify=True,
                 headers=headers,
                 data=data,
-                **params
+                params=params.get("params"),
+                stream=stream,
+                extra={ky: vl for ky, vl in params.items() if ky != "params"} or None,
             )
 
         except AuthClientError as e:
@@ -260,20 +379,35 @@ class QBS(LoggedClass):
 
         self.last_response = response
 
-        self.note(f"The final URL (with params): {response.url}, (call) data: {data}",
+        # This message gets built on every call, so only format the head of what may be a multi-MB upload/batch body
+        noted_data = data[:self.NOTE_DATA_CHARS] if data else data
+        self.note(f"The final URL (with params): {response.url}, (call) data: {noted_data}",
                   im="Inspect response:", tracer_at=16)
 
-        if response.status_code in QBOErrorHandler.SUPPORTED_STATUS_CODES:
+        # Decode a JSON body once, for the error handler and for whichever branch below returns or reports it
+        response_data = None
+
+        if headers.get("accept") == "application/json":
+            try:
+                response_data = json_loads(response.content)
+
+            except ValueError:
+                pass
+
+        # A successful non-JSON body (a PDF, say) has no faults in it, and may be a stream the caller still needs
+        if response.status_code in QBOErrorHandler.SUPPORTED_STATUS_CODES and (
+                response_data is not None or response.status_code != 200) and (
+                raise_item_faults or response.status_code != 200):
             # Raises CachingError if problem is addressed. It is up to callers further up the stack to retry in a way
             # that's suitable.
-            handler = QBOErrorHandler(self, response=response)
+            handler = QBOErrorHandler(self, response=response, response_data=response_data)
             handler.resolve()
             if handler.has_seen_a_suspected_transient_error:
                 del self.qba # In case something's wrong with the session itself!
 
-        if response.status_code in [200]:
+        if response.status_code == 200:
             if headers.get("accept") == "application/json":
-                rj = response.json()
+                rj = response_data if response_data is not None else json_loads(response.content)
 
                 self.note(rj, ta=15, print_at=11)
                 self.last_call_time = rj.get("time")
@@ -285,11 +419,7 @@ class QBS(LoggedClass):
             else:
                 return response.text
 
-        try:
-            error_message = response.json()
-
-        except:
-            error_message = response.text
+        error_message = response_data if response_data is not None else response.text
 
         self.note(error_message, im=f"How'd we handle this QBS error!?", tracer_at=3)
 
@@ -316,7 +446,8 @@ class QBS(LoggedClass):
               count_only: bool = False,
               start_position: Optional[int] = None,
               per_page: int = 1000,
-              select_fields: Optional[str] = None) -> Union[list, int]:
+              select_fields: Optional[str] = None,
+              max_workers: int = 1) -> Union[list, int]:
         """Query the QuickBooks Online API.
 
         Parameters
@@ -333,67 +464,67 @@ class QBS(LoggedClass):
             The number of objects to return per page.
         select_fields : str, optional
             The field(s) to use in the select statement, separated by commas.
+        max_workers : int
+            When greater than 1, count the matching objects first and, if there are at least two pages of them, fetch
+            the pages concurrently on up to this many threads. Defaults to 1 (page through serially).
 
         Returns
         -------
         list or int
         """
-        queried_all = False
-
-        if not select_fields:
-            select_what = "COUNT(*)" if count_only else "*"
-        else:
-            select_what = "COUNT(*)" if count_only else select_fields
-
-        where_tail = " " + where_tail if where_tail else ""
-        query = f"SELECT {select_what} FROM {object_type}{where_tail}"
+        if object_type in self.UNQUERIABLE_OBJECT_TYPES:
+            raise Exception(f"Can't query QB {object_type} objects!")
 
-        if not count_only:
-            query += f" MAXRESULTS {per_page}"
+        if count_only:
+            padded_tail = " " + where_tail if where_tail else ""
+            query = f"SELECT COUNT(*) FROM {object_type}{padded_tail}"
 
-        if start_position is not None:
-            query += f" STARTPOSITION {start_position}"
-            
-        url = f"{self.API_BASE_URL}/{self.cid}/query"
+            if start_position is not None:
+                query += f" STARTPOSITION {start_position}"
 
-        all_objs = []
+            total_count = self._query_response(f"{self.realm_url}/query", query)["totalCount"]
 
-        if object_type in self.UNQUERIABLE_OBJECT_TYPES:
-            raise Exception(f"Can't query QB {object_type} objects!")
+            if padded_tail in [None, "", " Active in (true,false)"]:
+                self.last_object_counts["object_type"] = total_count
 
-        base_len = len(query)
+            return total_count
 
-        while not queried_all:
-            if self.vb > 6:
-                self.print(query)
+        if max_workers > 1 and start_position is None:
+            total_count = self.query(object_type, where_tail=where_tail, count_only=True)
 
-            resp = self._basic_call(request_type="POST", url=url, data=query)
+            if total_count >= 2 * per_page:
+                return self._query_pages_parallel(
+                    object_type, where_tail, total_count, per_page, select_fields, max_workers)
 
-            self.note(resp, print_at=10)
+        return list(self.iter_query(object_type, where_tail=where_tail, start_position=start_position,
+                                    per_page=per_page, select_fields=select_fields))
 
-            if not resp or "QueryResponse" not in resp:
-                if self.vb > 1:
-                    self.print("Failed query was:")
-                    self.print(query)
 
-                    if resp:
-                        if isinstance(resp, (str, dict)) and resp:
-                            self.print(resp)
-                        else:
-                            self.print(resp.text)
-                            self.print(resp.status_code)
+    def iter_query(self,
+                   object_type: str,
+                   where_tail: Optional[str] = None,
+                   start_position: Optional[int] = None,
+                   per_page: int = 1000,
+                   select_fields: Optional[str] = None):
+        """Like `query`, but yield the objects a page at a time instead of collecting them all first.
 
-                raise Exception("Failed QBO Query")
+        Yields
+        ------
+        dict
+        """
+        if object_type in self.UNQUERIABLE_OBJECT_TYPES:
+            raise Exception(f"Can't query QB {object_type} objects!")
 
-            if count_only:
-                total_count = resp["QueryResponse"]["totalCount"]
-                if where_tail in [None, "", " Active in (true,false)"]:
-                    self.last_object_counts["object_type"] = total_count
-                return total_count
+        where_tail = " " + where_tail if where_tail else ""
+        base_query = f"SELECT {select_fields or '*'} FROM {object_type}{where_tail} MAXRESULTS {per_page}"
+        query = base_query if start_position is None else f"{base_query} STARTPOSITION {start_position}"
+        url = f"{self.realm_url}/query"
+        alias = self.ALIASES.get(object_type, object_type)
 
-            alias          = self.ALIASES.get(object_type, object_type)
-            objs           = resp["QueryResponse"].get(alias, [])
-            start_position = resp["QueryResponse"].get("startPosition")
+        while True:
+            query_response = self._query_response(url, query)
+            objs           = query_response.get(alias, [])
+            start_position = query_response.get("startPosition")
 
             if start_position is None:
                 # We started seeing null responses for this attribute on
@@ -401,7 +532,7 @@ class QBS(LoggedClass):
                 #  present prior to that)
                 start_position = 0
 
-            max_results    = resp["QueryResponse"].get("maxResults")
+            max_results    = query_response.get("maxResults")
 
             if max_results is None:
                 # We started seeing null responses for this attribute on
@@ -409,8 +540,6 @@ class QBS(LoggedClass):
                 #  present prior to that)
                 max_results = 0
 
-            all_objs      += objs
-
             if max_results > 0:
                 count_block = "" if not object_type in self.last_object_counts \
                     else f"of {self.last_object_counts[object_type]:,.0f:}"
@@ -419,17 +548,80 @@ class QBS(LoggedClass):
                     f"through {start_position + max_results - 1:,.0f}{count_block}.",
                 ])
                 self.note(progress_note, ta=11)
-                # if self.vb > 4:
-                #     self.print("Queried {:20s} objects {:>4} through {:4>}.".format(
-                #         object_type,
-                #         start_position,
-                #         start_position + max_results - 1))
+
+            yield from objs
 
             if max_results < per_page:
-                queried_all = True
+                return
 
             # This will be the NEXT query:
-            query = query[:base_len] + f" STARTPOSITION {start_position + per_page}"
+            query = f"{base_query} STARTPOSITION {start_position + per_page}"
+
+
+    def _query_response(self, url: str, query: str) -> dict:
+        """POST a single query and return its QueryResponse (raising if there isn't one)."""
+        if self.vb > 6:
+            self.print(query)
+
+        resp = self._basic_call(request_type="POST", url=url, data=query)
+
+        self.note(resp, print_at=10)
+
+        if not resp or "QueryResponse" not in resp:
+            if self.vb > 1:
+                self.print("Failed query was:")
+                self.print(query)
+
+                if resp:
+                    if isinstance(resp, (str, dict)) and resp:
+                        self.print(resp)
+                    else:
+                        self.print(resp.text)
+                        self.print(resp.status_code)
+
+            raise Exception("Failed QBO Query")
+
+        return resp["QueryResponse"]
+
+
+    def _query_pages_parallel(self,
+                              object_type: str,
+                              where_tail: Optional[str],
+                              total_count: int,
+                              per_page: int,
+                              select_fields: Optional[str],
+                              max_workers: int) -> list:
+        """Fetch every page of a query concurrently, given its `total_count` (see `query`).
+
+        Returns
+        -------
+        list
+            The objects, in the same order serial paging would have returned them.
+        """
+        padded_tail = " " + where_tail if where_tail else ""
+        base_query = f"SELECT {select_fields or '*'} FROM {object_type}{padded_tail} MAXRESULTS {per_page}"
+        url = f"{self.realm_url}/query"
+        alias = self.ALIASES.get(object_type, object_type)
+
+        # STARTPOSITION is 1-based
+        start_positions = range(1, total_count + 1, per_page)
+
+        def query_page(page_start):
+            return self._query_response(url, f"{base_query} STARTPOSITION {page_start}").get(alias, [])
+
+        # Settle authorization once up front rather than in every worker thread at the same time
+        self.qba.establish_access()
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(start_positions))) as executor:
+            pages = list(executor.map(query_page, start_positions))
+
+        all_objs = [obj for page in pages for obj in page]
+
+        if len(pages[-1]) >= per_page:
+            # Objects were added after the count was taken, so page through the rest serially
+            all_objs.extend(self.iter_query(object_type, where_tail=where_tail, per_page=per_page,
+                                            start_position=start_positions[-1] + per_page,
+                                            select_fields=select_fields))
 
         return all_objs
 
@@ -439,8 +631,12 @@ class QBS(LoggedClass):
         The object type isn't actually included in the object_dict, which is
          why you also have to pass that in (first).
         """
-        url = f"{self.API_BASE_URL}/{self.cid}/{object_type.lower()}"
+        url = f"{self.realm_url}/{object_type.lower()}"
         self.touchless_test()
+
+        if self._batch_queue is not None and not params:
+            return self._queue_batch_item("create", object_type, object_dict)
+
         return self._basic_call(request_type="POST", url=url, data=object_dict, **params)
 
     @logger.timeit(**returns)
@@ -450,7 +646,7 @@ class QBS(LoggedClass):
         """
         if len(params) > 0:
             raise NotImplementedError()
-        url = f"{self.API_BASE_URL}/{self.cid}/{object_type.lower()}/{object_id}"
+        url = f"{self.realm_url}/{object_type.lower()}/{object_id}"
 
         return self._basic_call(request_type="GET", url=url)
 
@@ -464,8 +660,12 @@ class QBS(LoggedClass):
         if len(params) > 0:
             raise NotImplementedError()
 
-        url = f"{self.API_BASE_URL}/{self.cid}/{object_type.lower()}"
+        url = f"{self.realm_url}/{object_type.lower()}"
         self.touchless_test()
+
+        if self._batch_queue is not None:
+            return self._queue_batch_item("update", object_type, object_dict)
+
         return self._basic_call(request_type="POST", url=url, data=object_dict)
 
     @logger.timeit(**returns)
@@ -479,7 +679,7 @@ class QBS(LoggedClass):
         if len(params) > 0:
             raise NotImplementedError()
 
-        url = f"{self.API_BASE_URL}/{self.cid}/{object_type.lower()}"
+        url = f"{self.realm_url}/{object_type.lower()}"
 
         if object_id and not object_dict:
             object_dict = self.read(object_type, object_id)[object_type]
@@ -489,22 +689,109 @@ class QBS(LoggedClass):
             "Id"        : object_dict["Id"],
             "SyncToken" : object_dict["SyncToken"]}
         self.touchless_test()
+
+        if self._batch_queue is not None:
+            return self._queue_batch_item("delete", object_type, skinny_dict)
+
         return self._basic_call(request_type="POST",
                                 url=url,
                                 data=skinny_dict,
                                 params={"operation": "delete"})
 
     @logger.timeit(**returns)
-    def batch(self, items):
+    def batch(self, items, raise_item_faults=True):
         """
         https://developer.intuit.com/app/developer/qbo/docs/api/
          accounting/all-entities/batch
+
+        With raise_item_faults=False, a Fault on some of the items doesn't raise (or retry the whole batch, re-sending
+        the items QBO did save); each item's Fault is left in its BatchItemResponse entry instead.
         """
-        url = f"{self.API_BASE_URL}/{self.cid}/batch"
+        url = f"{self.realm_url}/batch"
         self.touchless_test()
         return self._basic_call(request_type="POST",
                                 url=url,
-                                data={"BatchItemRequest": items})
+                                data={"BatchItemRequest": items},
+                                raise_item_faults=raise_item_faults)
+
+    @contextlib.contextmanager
+    def batch_context(self, flush_every: int = MAX_BATCH_ITEMS):
+        """Collect the create/update/delete calls made inside the block and send them through `batch`.
+
+        Inside the block those methods return a `concurrent.futures.Future` instead of the response; it resolves to
+        what the unbatched call would have returned (e.g. {"Invoice": {...}}), or raises BusinessValidationError with
+        the item's Fault. Queued operations go out every `flush_every` items and when the block exits. If the block
+        raises, whatever is still queued is cancelled rather than sent. Only calls made on this thread are queued; other
+        threads sharing the instance still get their responses straight away.
+
+        Parameters
+        ----------
+        flush_every : int
+            Operations per batch request (QBO's limit is MAX_BATCH_ITEMS).
+        """
+        if self._batch_queue is not None:
+            raise RuntimeError("batch_context() can't be nested")
+
+        self._batch_queue = []
+        self._batch_local.flush_every = max(1, min(flush_every, self.MAX_BATCH_ITEMS))
+
+        try:
+            yield self
+            self.flush_batch()
+
+        finally:
+            for _, future in self._batch_queue:
+                future.cancel()
+
+            self._batch_queue = None
+
+
+    def _queue_batch_item(self, operation: str, object_type: str, object_dict: dict) -> Future:
+        future = Future()
+        item = {
+            "bId"       : str(len(self._batch_queue)),
+            "operation" : operation,
+            object_type : object_dict}
+        self._batch_queue.append((item, future))
+
+        if len(self._batch_queue) >= self._batch_local.flush_every:
+            self.flush_batch()
+
+        return future
+
+
+    def flush_batch(self) -> None:
+        """Send the operations queued by `batch_context` and resolve their futures (a no-op outside of one)."""
+        if self._batch_queue is None:
+            return
+
+        queued, self._batch_queue = self._batch_queue, []
+
+        if not queued:
+            return
+
+        try:
+            # Item Faults are resolved per future below; raising on them would fail (and retry) the items QBO saved
+            resp = self.batch([item for item, _ in queued], raise_item_faults=False)
+
+        except Exception as ex:
+            for _, future in queued:
+                future.set_exception(ex)
+            raise
+
+        results = {result.get("bId"): result for result in resp.get("BatchItemResponse", [])}
+
+        for item, future in queued:
+            result = results.get(item["bId"])
+
+            if result is None:
+                future.set_exception(Exception(f"No BatchItemResponse for {item['operation']} bId {item['bId']}"))
+
+            elif "Fault" in result:
+                future.set_exception(BusinessValidationError(json.dumps(result["Fault"]), fault=result["Fault"]))
+
+            else:
+                future.set_result({ky: vl for ky, vl in result.items() if ky != "bId"})
 
     @logger.timeit(**returns)
     def change_data_capture(self, utc_since, object_types):
@@ -516,7 +803,7 @@ class QBS(LoggedClass):
         object_types should be a list, e.g.
          ["Purchase", "JournalEntry", "Vendor"]
         """
-        url = f"{self.API_BASE_URL}/{self.cid}/cdc"
+        url = f"{self.realm_url}/cdc"
 
         if isinstance(utc_since, datetime.datetime):
             # Either pass in a UTC datetime or a string formatted like this:
@@ -540,7 +827,7 @@ class QBS(LoggedClass):
         """
         Use the QBO reporting API, documented here:
         """
-        url = f"{self.API_BASE_URL}/{self.cid}/reports/{report_name}"
+        url = f"{self.realm_url}/reports/{report_name}"
 
         self.note(f"{report_name} params:\n\n{json.dumps(params, indent=4)}",
                   tracer_at=8, im="Inspect params")
@@ -585,7 +872,7 @@ class QBS(LoggedClass):
          of the attachable to get the name right (which will be all lower-case)
          and to achieve the attachment to one or more transaction entities.
         """
-        url       = f"{self.API_BASE_URL}/{self.cid}/upload"
+        url       = f"{self.realm_url}/upload"
         loc, name = os.path.split(path)
         base, ext = os.path.splitext(name)
         mime_type = self.ATTACHABLE_MIME_TYPES.get(ext.lower())
@@ -595,21 +882,23 @@ class QBS(LoggedClass):
 
         boundary  = "-------------PythonMultipartPost"
         headers   = {
-            "Content-Type"    : f"multipart/form-data;boundary={boundary}",
             "accept"          : "application/json",
-            "Connection"      : "close",
             #"Accept-Encoding" : "gzip;q=1.0,deflate;q=0.6,identity;q=0.3",
             #"User-Agent"      : "OAuth gem v0.4.7",
             "cache-control"   : "no-cache",
         }
 
         with open(path, "rb") as handle:
-            binary_data = b64encode(handle.read())
+            binary_data = handle.read()
 
         jd              = {
             "ContentType" : mime_type,
             "FileName"    : new_name if new_name else name,}
 
+        # See https://stackoverflow.com/questions/41030128/
+        #  str-encoding-from-latin-1-to-utf-8-arbitrarily
+        name = name.translate(self.BAD_CHARS_TABLE)
+
         if attach_to_object_type and attach_to_object_id:
             jd.update({
                 "AttachableRef" : [
@@ -618,31 +907,12 @@ class QBS(LoggedClass):
                         "value" : attach_to_object_id,},
                      "IncludeOnSend" : include_on_send},],})
 
-        request_body    = textwrap.dedent(
-            """
-            --{}
-            Content-Disposition: form-data; name="file_metadata_1";filename="{}"
-            Content-Type: application/json
-
-            {}
-            --{}
-            Content-Disposition: form-data; name="file_content_1";filename="{}"
-            Content-Type: {}
-            Content-Length: {:d}
-            Content-Transfer-Encoding: base64
-
-            {}
-            --{}--
-            """
-        ).format(boundary, "metadata.json", json.dumps(jd, indent=0),
-                 boundary, name, mime_type, len(binary_data),
-                 binary_data.decode('utf-8'), boundary)
-
-        for ky, vl in self.BAD_CHARS.items():
-            # See https://stackoverflow.com/questions/41030128/
-            #  str-encoding-from-latin-1-to-utf-8-arbitrarily
-            request_body = request_body.replace(ky, vl)
-        
+        # The file goes up as a raw binary part (no base64, so a third fewer bytes on the wire)
+        request_body, headers["Content-Type"] = encode_multipart_formdata({
+            "file_metadata_1": ("metadata.json", json.dumps(jd, indent=0), "application/json"),
+            "file_content_1" : (name, binary_data, mime_type),
+        }, boundary=boundary)
+
         data = {
             "headers"     : headers.copy(),
             "request_body": request_body
@@ -676,43 +946,45 @@ class QBS(LoggedClass):
 
         path      = os.path.join(loc, name)
 
-        handle    = open(path, "wb")
-
-        resp = requests.get(link, timeout=60)
-        status_code = str(resp.status_code)
-        method = str(resp.request.method.ljust(4))
-        reason = str(resp.reason)
-        response_url = str(resp.url)
-
-        try:
-            msg = (f"{resp.__hash__()} - {self.caller} - {self.client_code}({self.business_context}) - "
-                   f"{status_code} {reason} - {method} {response_url} - {resp.json()}")
-        except Exception as ex:
-            msg = (f"{resp.__hash__()} - {self.caller} - {self.client_code}({self.business_context}) - "
-                   f"{status_code} {reason} - {method} {response_url} - None")
-
-        try:
-            api_logger.log(
-                msg[:5000],
-                labels={
-                    'client_code': self.client_code,
-                    'context': self.business_context,
-                    'caller': self.caller,
-                    'method': method,
-                    'status_code': status_code,
-                    'reason': reason,
-                    'url': response_url,
-                    'realm_id': self.realm_id
-                }
-            )
-        except Exception:
-            self.exception()
-            self.info(msg)
-
-        for chunk in resp.iter_content(1024):
-            handle.write(chunk)
-
-        handle.close()
+        with self.download_session.get(link, timeout=(QBAuth2.CONNECT_TIMEOUT_SECS, 60), stream=True) as resp:
+            status_code = str(resp.status_code)
+            method = str(resp.request.method.ljust(4))
+            reason = str(resp.reason)
+            response_url = str(resp.url)
+
+            # The body is the attachment itself, so log its size rather than trying to parse it. The message is only
+            # formatted (by logging) if the record is actually emitted.
+            msg_format = "%x - %s - %s(%s) - %s %s - %s %s - %s bytes"
+            msg_args = (id(resp), self.caller, self.client_code, self.business_context, status_code, reason, method,
+                        response_url, resp.headers.get('Content-Length', '?'))
+
+            try:
+                _get_api_logger().info(
+                    msg_format,
+                    *msg_args,
+                    extra={'labels': {
+                        'client_code': self.client_code,
+                        'context': self.business_context,
+                        'caller': self.caller,
+                        'method': method,
+                        'status_code': status_code,
+                        'reason': reason,
+                        'url': response_url,
+                        'realm_id': self.realm_id
+                    }}
+                )
+            except Exception:
+                self.exception()
+                self.info(msg_format % msg_args)
+
+            # Don't write an error page to disk as if it were the attachment
+            resp.raise_for_status()
+
+            # Undo any Content-Encoding while copying straight from the socket to the file
+            resp.raw.decode_content = True
+
+            with open(path, "wb") as handle:
+                shutil.copyfileobj(resp.raw, handle, length=self.DOWNLOAD_CHUNK_SIZE)
 
         return path  # Because this may have changed if a directory was passed in
 
@@ -721,17 +993,15 @@ class QBS(LoggedClass):
         """
         https://developer.intuit.com/docs/api/accounting/invoice
         """
-        link   = f"{self.API_BASE_URL}/{self.cid}/{object_type.lower()}/{object_id}/pdf"
+        link   = f"{self.realm_url}/{object_type.lower()}/{object_id}/pdf"
 
         if self.vb > 4:
             self.print(f"Downloading {object_type} {object_id} from {link}...")
 
-        with open(path, "wb") as handle:
-            for chunk in self._basic_call(request_type="GET", url=link).iter_content(1024):
+        with self._basic_call(request_type="GET", url=link, stream=True) as pdf, open(path, "wb") as handle:
+            for chunk in pdf.iter_content(self.DOWNLOAD_CHUNK_SIZE):
                 handle.write(chunk)
 
-            handle.close()
-
         return link
 
     @logger.timeit(**returns)
@@ -739,7 +1009,7 @@ class QBS(LoggedClass):
         """
         https://developer.intuit.com/docs/api/accounting/invoice
         """
-        url   = f"{self.API_BASE_URL}/{self.cid}/{object_type.lower()}/{object_id}/send"
+        url   = f"{self.realm_url}/{object_type.lower()}/{object_id}/send"
 
         if self.vb > 4:
             self.print(f"Emailing {object_type} {object_id} to {recipient}...")
@@ -750,41 +1020,50 @@ class QBS(LoggedClass):
 
     @classmethod
     def get_where_in_query_string(cls, select_field: str, values: list, object_type: str) -> str:
-        values_string = ','.join([f"'{i}'" for i in values])
+        values_string = "'" + "','".join(map(str, values)) + "'" if values else ""
         query = f'WHERE {select_field} IN ({values_string})'
 
-        if object_type not in QBO.TRANSACTION_OBJECTS + QBO.OTHER_OBJECTS:
+        if object_type not in cls.NO_ACTIVE_FLAG_OBJECTS:
             query = f'{query} AND Active in (true,false)'
 
         return query
 
-    def get_missing(self, object_type: str, values: list, select_field: str):
+    def get_missing(self, object_type: str, values: list, select_field: str, max_workers: int = 1):
         """
         Returns the values missing from QuickBooks.
+
+        With max_workers > 1 the chunked lookups (see below) run concurrently on up to that many threads; keep it
+        small, since QBO throttles concurrent requests per realm.
         """
-        starting_index = 0
-        max_count = 999
-        values_count = len(values)
-        missing_values = []
+        max_count = self.MAX_WHERE_IN_VALUES
 
         # We query in increments so that we don't blow up on supersized value lists (e.g. cdc.py)
+        values_subsets = [values[ix : ix + max_count] for ix in range(0, len(values), max_count)]
 
-        while starting_index < values_count:
-            values_subset = values[starting_index : starting_index + max_count]
-
+        def get_missing_subset(values_subset):
             where_tail = self.get_where_in_query_string(
                 select_field=select_field,
                 values=values_subset,
                 object_type=object_type
             )
-            response = self.query(object_type=object_type, where_tail=where_tail, select_fields=select_field)
-            existing = [i.get(select_field) for i in response]
-            missing = list(set(values_subset).difference(existing))
-            missing_values.extend(missing)
+            existing = {
+                obj.get(select_field)
+                for obj in self.iter_query(object_type=object_type, where_tail=where_tail, select_fields=select_field)
+            }
+            # dict.fromkeys() drops duplicates like the old set difference did, but keeps the callers' order
+            return [vl for vl in dict.fromkeys(values_subset) if vl not in existing]
 
-            starting_index += max_count
+        if max_workers > 1 and len(values_subsets) > 1:
+            # Build `qba` and settle authorization once up front rather than in every worker thread at the same time
+            self.qba.establish_access()
 
-        return missing_values
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(values_subsets))) as executor:
+                missing_subsets = list(executor.map(get_missing_subset, values_subsets))
+
+        else:
+            missing_subsets = map(get_missing_subset, values_subsets)
+
+        return [vl for missing_subset in missing_subsets for vl in missing_subset]
 
 
     @property
@@ -830,6 +1109,22 @@ class QBS(LoggedClass):
         return self._offering_sku
 
 
+    def close(self) -> None:
+        """Release the pooled connections held by this instance (and its QBAuth2)."""
+        if hasattr(self, '_download_session'):
+            self._download_session.close()
+            del self._download_session
+
+        with self._qba_lock:
+            qba = self.__dict__.pop('_qba', None)
+
+        if qba is not None:
+            # Forgotten too (as the qba deleter does, minus its pause), so a later call builds a fresh one rather than
+            # reaching the closed client
+            qba.close()
+            del self.realm_url
+
+
     def __repr__(self):
         return f"<{self.cid} QBS (OAuth Version {self.oauth_version})>"
 
@@ -848,7 +1143,11 @@ class QBS(LoggedClass):
         if self.touchless_mode and not environment.is_production():
             error = 'Touchless Failure'
             print(error)
-            import ipdb;ipdb.set_trace()
+
+            if os.environ.get("FO_QBO_DEBUG"):
+                # Opt-in only, so that an unattended run can't hang waiting on a debugger
+                import ipdb;ipdb.set_trace()
+
             raise Exception(error)
 
 